@@ -1,35 +1,243 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Any
-from googleapiclient.discovery import build
+from uuid import uuid4
+import httpx
+from cachetools import TTLCache
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 
-from app.google_oauth import load_creds
+from app.google_oauth import TOKENS_DIR, load_creds, save_creds
 
+log = logging.getLogger(__name__)
 
-def service_for(user_id: str):
+# Tokens this close to expiry are refreshed in the background while the
+# still-valid token keeps serving requests. google-auth already treats a token
+# as invalid 3m45s before expiry (its private _helpers.REFRESH_THRESHOLD), so
+# the window opens that much earlier again.
+_GOOGLE_AUTH_REFRESH_THRESHOLD = timedelta(seconds=225)
+_REFRESH_MARGIN = _GOOGLE_AUTH_REFRESH_THRESHOLD + timedelta(seconds=225)
+_REFRESH_LOCKS: dict[str, asyncio.Lock] = {}
+_REFRESH_TASKS: set[asyncio.Task] = set()
+# user_id -> access token whose background refresh failed (e.g. revoked refresh
+# token). No more background attempts until that token is replaced; the inline
+# refresh at expiry surfaces the error to the caller.
+_REFRESH_FAILED: dict[str, str] = {}
+
+# Upper bound on "items" in a single freeBusy query
+FREEBUSY_MAX_ITEMS = 50
+
+# Recent freebusy answers, so follow-up questions in one conversation don't
+# re-query Google. Keyed by (user_id, calendar_ids, time_min, time_max).
+_FB_CACHE: TTLCache = TTLCache(maxsize=256, ttl=30)
+
+# Meet createRequest ids for recent bookings, kept on disk so a retried create
+# reuses its id across restarts and workers. Like the OAuth state store, one
+# connection per process behind a lock; only call the accessor via to_thread.
+IDEMPOTENCY_DB = os.path.join(TOKENS_DIR, "calendar.db")
+IDEMPOTENCY_TTL_SEC = 600
+_IDEM_CONN = sqlite3.connect(IDEMPOTENCY_DB, timeout=5.0, check_same_thread=False)
+_IDEM_LOCK = threading.Lock()
+
+with _IDEM_LOCK, _IDEM_CONN:
+    _IDEM_CONN.execute("PRAGMA journal_mode=WAL")
+    _IDEM_CONN.execute(
+        "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+        "key TEXT PRIMARY KEY, req_id TEXT NOT NULL, created REAL NOT NULL)"
+    )
+
+# Pooled client for all Calendar REST calls. httpx.AsyncClient is safe to share
+# across concurrent requests, unlike googleapiclient's per-service httplib2.Http.
+_API_CLIENT = httpx.AsyncClient(
+    base_url="https://www.googleapis.com/calendar/v3",
+    timeout=httpx.Timeout(30.0, connect=10.0),
+    limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+)
+
+
+def _utcnow() -> datetime:
+    # google-auth keeps expiry as naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _is_expired(creds: Credentials) -> bool:
+    return not creds.token or (creds.expiry is not None and creds.expiry <= _utcnow())
+
+
+def _is_stale(creds: Credentials) -> bool:
+    if not creds.expiry:
+        return False
+    return creds.expiry - _utcnow() < _REFRESH_MARGIN
+
+
+def _refresh_lock(user_id: str) -> asyncio.Lock:
+    return _REFRESH_LOCKS.setdefault(user_id, asyncio.Lock())
+
+
+async def _background_refresh(user_id: str, creds: Credentials):
+    async with _refresh_lock(user_id):
+        if not _is_stale(creds) or _refresh_failed(user_id, creds):
+            return  # a refresh queued ahead of us already did (or failed) the work
+        token = creds.token
+        try:
+            await asyncio.to_thread(creds.refresh, Request())
+        except Exception as e:
+            # Token is still valid; creds_for refreshes inline once it expires.
+            log.warning("Background token refresh failed for %s: %s", user_id, e)
+            _REFRESH_FAILED[user_id] = token
+            return
+        _REFRESH_FAILED.pop(user_id, None)
+        await save_creds(user_id, creds)
+
+
+async def _force_refresh(user_id: str, creds: Credentials, rejected_token: str | None):
+    """
+    Refresh creds after the API rejected rejected_token, unless a concurrent
+    caller already replaced it.
+    """
+    async with _refresh_lock(user_id):
+        if creds.token != rejected_token:
+            return
+        await asyncio.to_thread(creds.refresh, Request())
+        await save_creds(user_id, creds)
+
+
+def _refresh_failed(user_id: str, creds: Credentials) -> bool:
+    return user_id in _REFRESH_FAILED and _REFRESH_FAILED[user_id] == creds.token
+
+
+def _schedule_refresh(user_id: str, creds: Credentials):
+    """
+    Refresh creds off the request path unless a refresh for this user is
+    already in flight or has already failed for the current token.
+    """
+    lock = _REFRESH_LOCKS.get(user_id)
+    if lock and lock.locked():
+        return
+    if _refresh_failed(user_id, creds):
+        return
+    task = asyncio.create_task(_background_refresh(user_id, creds))
+    _REFRESH_TASKS.add(task)
+    task.add_done_callback(_REFRESH_TASKS.discard)
+
+
+async def creds_for(user_id: str) -> Credentials:
     """
-    Build an authenticated Google Calendar service for the given user_id.
+    Return valid Google credentials for the given user_id.
     Requires that OAuth tokens exist (tokens/<user_id>.json) from the /auth/google flow.
+    Only blocks on a token refresh when the token has actually expired.
     """
-    creds: Credentials | None = load_creds(user_id)
+    creds: Credentials | None = await load_creds(user_id)
     if not creds:
         raise ValueError("Google not connected for this user_id")
-    if not creds.valid and creds.refresh_token:
-        creds.refresh(Request())
-    return build("calendar", "v3", credentials=creds)
+    if creds.refresh_token:
+        if _is_expired(creds):
+            # One refresh per user: concurrent callers wait, then find it done
+            async with _refresh_lock(user_id):
+                if _is_expired(creds):
+                    await asyncio.to_thread(creds.refresh, Request())
+                    await save_creds(user_id, creds)
+        elif _is_stale(creds):
+            _schedule_refresh(user_id, creds)
+    return creds
 
 
-def freebusy(user_id: str, time_min: str, time_max: str, calendar_id: str = "primary") -> List[Dict[str, str]]:
+async def _authorized_post(
+    user_id: str,
+    creds: Credentials,
+    path: str,
+    body: Dict[str, Any],
+    params: Dict[str, Any] | None = None,
+) -> Dict[str, Any]:
     """
-    Return busy blocks for the user's calendar between time_min and time_max (ISO8601).
+    POST to the Calendar REST API with creds' bearer token. On a 401 (token
+    revoked or rotated before expiry) refresh once and retry, as the
+    google-auth transport would.
     """
-    svc = service_for(user_id)
-    body = {"timeMin": time_min, "timeMax": time_max, "items": [{"id": calendar_id}]}
-    fb = svc.freebusy().query(body=body).execute()
-    return fb["calendars"][calendar_id].get("busy", [])
+    token = creds.token
+    r = await _API_CLIENT.post(path, json=body, params=params, headers={"Authorization": f"Bearer {token}"})
+    if r.status_code == 401 and creds.refresh_token:
+        await _force_refresh(user_id, creds, token)
+        r = await _API_CLIENT.post(path, json=body, params=params, headers={"Authorization": f"Bearer {creds.token}"})
+    r.raise_for_status()
+    return r.json()
+
+
+async def aclose():
+    await _API_CLIENT.aclose()
+
+
+async def freebusy(user_id: str, time_min: str, time_max: str, calendar_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Query busy blocks for several calendars between time_min and time_max (ISO8601)
+    in as few API calls as possible (the API takes up to 50 calendars per query).
+    Returns the raw "calendars" mapping: {calendar_id: {"busy": [...], "errors": [...]}}.
+    Posts straight to the REST endpoint on the shared async client.
+    Answers are cached for a few seconds per user and window.
+    """
+    # Resolve credentials first (cheap: cached in memory) so a disconnected user
+    # gets the "not connected" error rather than a cached answer
+    creds = await creds_for(user_id)
+    if not creds.token:
+        raise ValueError("Google not connected for this user_id")
+
+    key = (user_id, tuple(calendar_ids), time_min, time_max)
+    cached = _FB_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    async def query(chunk: List[str]) -> Dict[str, Dict[str, Any]]:
+        body = {"timeMin": time_min, "timeMax": time_max, "items": [{"id": cid} for cid in chunk]}
+        fb = await _authorized_post(user_id, creds, "/freeBusy", body)
+        return fb.get("calendars", {})
 
+    # More than one chunk only for very large invites; those queries run concurrently
+    chunks = [calendar_ids[i:i + FREEBUSY_MAX_ITEMS] for i in range(0, len(calendar_ids), FREEBUSY_MAX_ITEMS)]
+    calendars: Dict[str, Dict[str, Any]] = {}
+    for part in await asyncio.gather(*(query(c) for c in chunks)):
+        calendars.update(part)
+    _FB_CACHE[key] = calendars
+    return calendars
 
-def create_event(
+
+def _invalidate_freebusy(user_id: str):
+    for key in [k for k in list(_FB_CACHE.keys()) if k[0] == user_id]:
+        _FB_CACHE.pop(key, None)
+
+
+def idempotency_key_get(key: str) -> str:
+    """
+    Return the request id stored for key, minting a new one if none is live.
+    INSERT OR IGNORE + SELECT keeps concurrent workers on the same id.
+    """
+    now = time.time()
+    with _IDEM_LOCK, _IDEM_CONN:
+        _IDEM_CONN.execute("DELETE FROM idempotency_keys WHERE created < ?", (now - IDEMPOTENCY_TTL_SEC,))
+        _IDEM_CONN.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (key, req_id, created) VALUES (?, ?, ?)",
+            (key, f"req-{uuid4().hex[:16]}", now),
+        )
+        row = _IDEM_CONN.execute("SELECT req_id FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+    return row[0]
+
+
+async def _request_id(user_id: str, start: str, end: str, attendees: List[str]) -> str:
+    """
+    Meet createRequest id for a booking. A retried create of the same
+    (user_id, start, end, attendees) within the TTL reuses its id instead of
+    minting a new room; the mapping is kept in tokens/calendar.db.
+    """
+    key = hashlib.blake2b("|".join([user_id, start, end, *attendees]).encode(), digest_size=16).hexdigest()
+    return await asyncio.to_thread(idempotency_key_get, key)
+
+
+async def create_event(
     user_id: str,
     title: str,
     start: str,
@@ -42,7 +250,9 @@ def create_event(
     Create a calendar event with optional Google Meet conferencing.
     Returns dict with event_id, hangoutLink (join link), htmlLink (calendar UI link).
     """
-    svc = service_for(user_id)
+    creds = await creds_for(user_id)
+    if not creds.token:
+        raise ValueError("Google not connected for this user_id")
 
     event: Dict[str, Any] = {
         "summary": title,
@@ -56,18 +266,20 @@ def create_event(
         # Ensure Meet is created and extractable
         event["conferenceData"] = {
             "createRequest": {
-                "requestId": f"req-{abs(hash((title, start, end))) % 1_000_000}",
+                "requestId": await _request_id(user_id, start, end, attendees),
                 "conferenceSolutionKey": {"type": "hangoutsMeet"}
             }
         }
         conf_ver = 1
 
-    created = svc.events().insert(
-        calendarId="primary",
-        body=event,
-        conferenceDataVersion=conf_ver,
-        sendUpdates="all"
-    ).execute()
+    created = await _authorized_post(
+        user_id,
+        creds,
+        "/calendars/primary/events",
+        event,
+        params={"conferenceDataVersion": conf_ver, "sendUpdates": "all"},
+    )
+    _invalidate_freebusy(user_id)
 
     # Prefer conferenceData.entryPoints[...].uri; fall back to hangoutLink
     join_link = None
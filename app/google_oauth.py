@@ -1,4 +1,6 @@
-import os, json
+import os, json, sqlite3, time, asyncio, threading, tempfile
+import aiofiles
+import aiofiles.os
 from fastapi import APIRouter, HTTPException, Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
@@ -17,33 +19,89 @@ SCOPES = ["https://www.googleapis.com/auth/calendar"]
 TOKENS_DIR = "tokens"
 os.makedirs(TOKENS_DIR, exist_ok=True)
 
-STATE_FILE = os.path.join(TOKENS_DIR, "state.json")
-if not os.path.exists(STATE_FILE):
-    with open(STATE_FILE, "w") as f:
-        json.dump({}, f)
-
-def state_store_get() -> dict:
-    try:
-        return json.load(open(STATE_FILE))
-    except Exception:
-        return {}
+# OAuth state -> user_id, one row per pending /start. SQLite gives us atomic
+# per-state writes, so concurrent flows no longer overwrite each other.
+STATE_DB = os.path.join(TOKENS_DIR, "state.db")
+STATE_TTL_SEC = 600
+
+# One connection for the process, shared across threadpool callers (the sync
+# endpoints, and the async callback via asyncio.to_thread), so access is
+# serialized with a lock rather than reconnecting per OAuth hop. These calls can
+# block on the lock or SQLite's busy timeout: never call them on the event loop.
+_STATE_CONN = sqlite3.connect(STATE_DB, timeout=5.0, check_same_thread=False)
+_STATE_LOCK = threading.Lock()
+
+with _STATE_LOCK, _STATE_CONN:
+    _STATE_CONN.execute("PRAGMA journal_mode=WAL")
+    _STATE_CONN.execute(
+        "CREATE TABLE IF NOT EXISTS oauth_state ("
+        "state TEXT PRIMARY KEY, user_id TEXT NOT NULL, created REAL NOT NULL)"
+    )
 
-def state_store_set(data: dict):
-    with open(STATE_FILE, "w") as f:
-        json.dump(data, f)
+def state_store_put(state: str, user_id: str):
+    now = time.time()
+    with _STATE_LOCK, _STATE_CONN:
+        _STATE_CONN.execute("DELETE FROM oauth_state WHERE created < ?", (now - STATE_TTL_SEC,))
+        _STATE_CONN.execute(
+            "INSERT OR REPLACE INTO oauth_state (state, user_id, created) VALUES (?, ?, ?)",
+            (state, user_id, now),
+        )
+
+def state_store_get(state: str) -> str | None:
+    """Return the user_id for a pending, unexpired OAuth state."""
+    with _STATE_LOCK:
+        row = _STATE_CONN.execute(
+            "SELECT user_id FROM oauth_state WHERE state = ? AND created >= ?",
+            (state, time.time() - STATE_TTL_SEC),
+        ).fetchone()
+    return row[0] if row else None
+
+def state_store_delete(state: str):
+    with _STATE_LOCK, _STATE_CONN:
+        _STATE_CONN.execute("DELETE FROM oauth_state WHERE state = ?", (state,))
 
 def token_path(user_id: str) -> str:
     return os.path.join(TOKENS_DIR, f"{user_id}.json")
 
-def load_creds(user_id: str) -> Credentials | None:
-    p = token_path(user_id)
-    if not os.path.exists(p): return None
-    data = json.load(open(p))
-    return Credentials.from_authorized_user_info(data, SCOPES)
+# Parsed credentials per user_id, keyed by the token file's mtime so an
+# external rewrite of tokens/<user_id>.json is picked up on the next call.
+_CREDS_CACHE: dict[str, tuple[float, Credentials]] = {}
 
-def save_creds(user_id: str, creds: Credentials):
-    with open(token_path(user_id), "w") as f:
-        f.write(creds.to_json())
+async def load_creds(user_id: str) -> Credentials | None:
+    p = token_path(user_id)
+    try:
+        mtime = (await aiofiles.os.stat(p)).st_mtime
+    except FileNotFoundError:
+        _CREDS_CACHE.pop(user_id, None)
+        return None
+    cached = _CREDS_CACHE.get(user_id)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    async with aiofiles.open(p) as f:
+        data = json.loads(await f.read())
+    creds = Credentials.from_authorized_user_info(data, SCOPES)
+    _CREDS_CACHE[user_id] = (mtime, creds)
+    return creds
+
+def _write_atomic(p: str, data: str) -> float:
+    """
+    Write data to a temp file next to p and rename it into place, so readers
+    never see a truncated or half-written token file. Returns the new mtime.
+    """
+    fd, tmp = tempfile.mkstemp(dir=TOKENS_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp, p)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return os.stat(p).st_mtime
+
+async def save_creds(user_id: str, creds: Credentials):
+    mtime = await asyncio.to_thread(_write_atomic, token_path(user_id), creds.to_json())
+    # Keep the cache pointing at the object we just wrote (e.g. after a refresh)
+    _CREDS_CACHE[user_id] = (mtime, creds)
 
 def build_flow() -> Flow:
     if not CLIENT_ID or not CLIENT_SECRET or not REDIRECT_URI:
@@ -72,21 +130,17 @@ def start(user_id: str):
         include_granted_scopes="true",
         prompt="consent"
     )
-    store = state_store_get()
-    store[state] = {"user_id": user_id}
-    state_store_set(store)
+    state_store_put(state, user_id)
     return {"auth_url": auth_url, "state": state}
 
 @router.get("/callback")
-def callback(request: Request, state: str | None = None, code: str | None = None):
+async def callback(request: Request, state: str | None = None, code: str | None = None):
     # print("CALLBACK QUERY:", dict(request.query_params))  # uncomment to debug errors
     if not state:
         raise HTTPException(status_code=400, detail="Missing state")
-    store = state_store_get()
-    entry = store.get(state)
-    if not entry or "user_id" not in entry:
+    user_id = await asyncio.to_thread(state_store_get, state)
+    if not user_id:
         raise HTTPException(status_code=400, detail="Unknown or expired state.")
-    user_id = entry["user_id"]
 
     flow = build_flow()
     flow.redirect_uri = REDIRECT_URI
@@ -94,13 +148,13 @@ def callback(request: Request, state: str | None = None, code: str | None = None
         # Surface Google error message if present
         q = dict(request.query_params)
         raise HTTPException(status_code=400, detail=f"OAuth error: {q.get('error')} {q.get('error_description')}")
-    flow.fetch_token(code=code)
+    # token exchange is a blocking HTTP call; keep it off the event loop
+    await asyncio.to_thread(flow.fetch_token, code=code)
     creds = flow.credentials
-    save_creds(user_id, creds)
+    await save_creds(user_id, creds)
 
     # cleanup
-    store.pop(state, None)
-    state_store_set(store)
+    await asyncio.to_thread(state_store_delete, state)
 
     return {"ok": True, "message": f"Google connected for {user_id}"}
 
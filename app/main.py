@@ -1,18 +1,26 @@
-import os, json
+import os, asyncio, copy
+import aiofiles.os
 import httpx
+import orjson
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from typing import Dict, Any
 
 from app.tools import TOOL_REGISTRY
-from app.google_oauth import router as google_auth_router
+from app.google_oauth import router as google_auth_router, token_path
+from app import google_calendar
 
 load_dotenv()
 
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "mistral")
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
 OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "180"))
+# Keep the model (and its prompt cache) resident between requests, and pin the
+# context size: a differing num_ctx makes Ollama reload the model and re-run prefill.
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "4096"))
 
 SYSTEM_PROMPT = (
     "You are a scheduling assistant that can call tools by returning EXACTLY ONE JSON object.\n"
@@ -32,6 +40,10 @@ SYSTEM_PROMPT = (
 
 FEW_SHOT = []  # optional: add examples later
 
+# Parsed tool calls for recent (user_id, message) pairs, so a retry or a duplicate
+# submit of the same request skips the first LLM round-trip
+_INTENT_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=10)
+
 class ChatIn(BaseModel):
     user_id: str
     message: str
@@ -42,20 +54,31 @@ class ChatOut(BaseModel):
 app = FastAPI()
 app.include_router(google_auth_router)
 
+# One pooled client for the app's lifetime so keep-alive connections to Ollama are reused
+_LLM_CLIENT = httpx.AsyncClient(
+    base_url=OLLAMA_HOST,
+    timeout=httpx.Timeout(OLLAMA_TIMEOUT, connect=10.0),
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+)
+
+@app.on_event("shutdown")
+async def close_clients():
+    await _LLM_CLIENT.aclose()
+    await google_calendar.aclose()
+
 async def call_llm(messages: list[dict]) -> str:
     payload = {
         "model": OLLAMA_MODEL,
         "messages": messages,
         "stream": False,
-        "options": {"temperature": 0}
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {"temperature": 0, "num_ctx": OLLAMA_NUM_CTX}
     }
-    timeout = httpx.Timeout(OLLAMA_TIMEOUT, read=OLLAMA_TIMEOUT, connect=10.0)
     try:
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            r = await client.post(f"{OLLAMA_HOST}/api/chat", json=payload)
-            r.raise_for_status()
-            data = r.json()
-            return (data.get("message") or {}).get("content") or ""
+        r = await _LLM_CLIENT.post("/api/chat", json=payload)
+        r.raise_for_status()
+        data = r.json()
+        return (data.get("message") or {}).get("content") or ""
     except httpx.ReadTimeout:
         raise HTTPException(
             status_code=504,
@@ -65,29 +88,107 @@ async def call_llm(messages: list[dict]) -> str:
     except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=f"Ollama request failed: {e}")
 
+# A tool call is a small JSON object; anything bigger is prose, not worth parsing
+MAX_TOOL_CALL_CHARS = 64 * 1024
+
 def maybe_parse_tool_call(text: str) -> Dict[str, Any] | None:
     text = text.strip()
-    if not text.startswith("{"):
+    if not text.startswith("{") or len(text) > MAX_TOOL_CALL_CHARS:
+        return None
+    # cheap reject before a full parse
+    if '"tool"' not in text or '"args"' not in text:
         return None
     try:
-        obj = json.loads(text)
+        obj = orjson.loads(text)
         if isinstance(obj, dict) and "tool" in obj and "args" in obj:
             return obj
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         pass
     return None
 
-@app.get("/health")
-async def health():
-    reachable = False
+def format_create_event(result: Dict[str, Any]) -> str:
+    reply = f"✅ Booked '{result['title']}' from {result['start_time']} to {result['end_time']}."
+    if result.get("join_link"):
+        reply += f" Join: {result['join_link']}"
+    return reply
+
+def format_suggest_times(result: Dict[str, Any]) -> str:
+    candidates = result.get("candidates") or []
+    if not candidates:
+        return (f"I couldn't find a free {result['duration_minutes']}-minute slot between "
+                f"{result['window_start']} and {result['window_end']}. Want me to try another window?")
+    lines = [f"Here are some {result['duration_minutes']}-minute slots ({result['organizer_tz']}):"]
+    for i, c in enumerate(candidates, 1):
+        lines.append(f"{i}. {c['start']} – {c['end']}")
+    lines.append("Which one should I book?")
+    return "\n".join(lines)
+
+# Budget for the tool_result we feed back to the model: prefill time grows with it
+MAX_BUSY_IN_PROMPT = 20
+TOOL_RESULT_MAX_CHARS = 8192
+
+def bound_tool_result(name: str, result: Dict[str, Any]) -> str:
+    """
+    Serialize the tool_result message, trimming it to fit the prompt budget.
+    """
+    busy = result.get("busy")
+    if name == "get_availability" and isinstance(busy, list) and len(busy) > MAX_BUSY_IN_PROMPT:
+        result = {
+            **result,
+            "busy": sorted(busy, key=lambda b: b["start"])[:MAX_BUSY_IN_PROMPT],
+            "busy_omitted": len(busy) - MAX_BUSY_IN_PROMPT,
+        }
+    def encode(r: Dict[str, Any]) -> bytes:
+        return orjson.dumps({"tool_result": {"name": name, "result": r}})
+
+    content = encode(result)
+    if len(content) <= TOOL_RESULT_MAX_CHARS:
+        return content.decode()
+
+    # Still too big. busy is what suggest_times needs, so it is shrunk but never
+    # dropped; the supporting lists go first.
+    result = {k: v for k, v in result.items() if k not in ("participants", "unavailable_calendars")}
+    result["truncated"] = True
+    content = encode(result)
+    busy = result.get("busy")
+    if isinstance(busy, list):
+        total = len(busy) + result.get("busy_omitted", 0)
+        while len(content) > TOOL_RESULT_MAX_CHARS and len(busy) > 1:
+            busy = busy[:len(busy) // 2]
+            result["busy"] = busy
+            result["busy_omitted"] = total - len(busy)
+            content = encode(result)
+    if len(content) > TOOL_RESULT_MAX_CHARS:
+        # Last resort: scalar fields plus busy
+        result = {k: v for k, v in result.items() if k == "busy" or not isinstance(v, (list, dict))}
+        content = encode(result)
+    return content.decode()
+
+# Tools whose structured result is rendered directly, skipping the follow-up LLM call
+DIRECT_REPLIES = {
+    "create_event": format_create_event,
+    "suggest_times": format_suggest_times,
+}
+
+async def ollama_reachable() -> bool:
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(5.0, connect=3.0)) as client:
-            rr = await client.get(f"{OLLAMA_HOST}/api/tags")
-            rr.raise_for_status()
-            reachable = True
+        rr = await _LLM_CLIENT.get("/api/tags", timeout=httpx.Timeout(5.0, connect=3.0))
+        rr.raise_for_status()
+        return True
     except httpx.HTTPError:
-        pass
-    return {"ok": True, "model": OLLAMA_MODEL, "ollama_reachable": reachable, "timeout_sec": OLLAMA_TIMEOUT}
+        return False
+
+@app.get("/health")
+async def health(user_id: str | None = None):
+    # Probes run concurrently so /health takes as long as the slowest one
+    probes = [ollama_reachable()]
+    if user_id:
+        probes.append(aiofiles.os.path.exists(token_path(user_id)))
+    reachable, *google = await asyncio.gather(*probes)
+    out = {"ok": True, "model": OLLAMA_MODEL, "ollama_reachable": reachable, "timeout_sec": OLLAMA_TIMEOUT}
+    if google:
+        out["google_connected"] = google[0]
+    return out
 
 @app.post("/chat", response_model=ChatOut)
 async def chat(body: ChatIn):
@@ -97,12 +198,18 @@ async def chat(body: ChatIn):
         *FEW_SHOT,
         {"role": "user", "content": body.message},
     ]
-    first = await call_llm(messages)
-
-    # Check for a tool call
-    tool_call = maybe_parse_tool_call(first)
-    if not tool_call:
-        return ChatOut(reply=first)
+    intent_key = (body.user_id, body.message)
+    tool_call = _INTENT_CACHE.get(intent_key)
+    if tool_call is None:
+        first = await call_llm(messages)
+
+        # Check for a tool call
+        tool_call = maybe_parse_tool_call(first)
+        if not tool_call:
+            return ChatOut(reply=first)
+        _INTENT_CACHE[intent_key] = tool_call
+    # args get filled in below; keep the cached copy pristine
+    tool_call = copy.deepcopy(tool_call)
 
     name = tool_call["tool"]
     args = tool_call.get("args", {})
@@ -119,9 +226,13 @@ async def chat(body: ChatIn):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Tool {name} error: {e}")
 
+    formatter = DIRECT_REPLIES.get(name)
+    if formatter:
+        return ChatOut(reply=formatter(result))
+
     # Send tool result back to the model and get final reply
     messages.extend([
-        {"role": "assistant", "content": json.dumps({"tool_result": {"name": name, "result": result}})}
+        {"role": "assistant", "content": bound_tool_result(name, result)}
     ])
     final = await call_llm(messages)
     return ChatOut(reply=final or "(no response)")
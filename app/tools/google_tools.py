@@ -1,9 +1,12 @@
 from typing import Dict, Any, List
 from datetime import datetime, timezone, timedelta
 from dateutil import parser as dtparse
-from zoneinfo import ZoneInfo
 
 from app.google_calendar import freebusy, create_event as g_create
+from app.tools.timezones import get_tz
+
+
+_SEMI_TABLE = str.maketrans({";": ","})
 
 
 def _normalize_attendees(attendees_raw) -> List[str]:
@@ -14,18 +17,19 @@ def _normalize_attendees(attendees_raw) -> List[str]:
       - ["a@x.com", "b@y.com"]
       - [{"email":"a@x.com"}, ...]
       - {"email":"a@x.com"}
-    Returns: list[str] of emails.
+    Returns: list[str] of emails, de-duped in first-seen order.
     """
-    emails: List[str] = []
+    result: List[str] = []
+    seen = set()
 
     def add_email(s: str):
         s = (s or "").strip()
-        if s and "@" in s:
-            emails.append(s)
+        if s and "@" in s and s not in seen:
+            seen.add(s)
+            result.append(s)
 
     if isinstance(attendees_raw, str):
-        parts = attendees_raw.replace(";", ",").split(",")
-        for p in parts:
+        for p in attendees_raw.translate(_SEMI_TABLE).split(","):
             add_email(p)
 
     elif isinstance(attendees_raw, dict):
@@ -38,13 +42,6 @@ def _normalize_attendees(attendees_raw) -> List[str]:
             elif isinstance(item, dict):
                 add_email(item.get("email", ""))
 
-    # de-dupe while preserving order
-    seen = set()
-    result = []
-    for e in emails:
-        if e not in seen:
-            seen.add(e)
-            result.append(e)
     return result
 
 
@@ -54,7 +51,7 @@ async def get_availability(params: Dict[str, Any]) -> Dict[str, Any]:
     """
     user_id = params.get("organizer_user_id", "demo")
     tz_name = params.get("organizer_tz", "America/New_York")
-    tz = ZoneInfo(tz_name)
+    tz = get_tz(tz_name)
 
     window_start = params["window_start"]
     window_end = params["window_end"]
@@ -82,12 +79,26 @@ async def get_availability(params: Dict[str, Any]) -> Dict[str, Any]:
     if isinstance(participants, str):
         participants = [{"email": p.strip()} for p in participants.replace(";", ",").split(",") if p.strip()]
 
-    busy = freebusy(user_id, window_start, window_end)
+    # One batched query for the organizer ("primary") and every participant
+    calendar_ids = ["primary", *_normalize_attendees(participants)]
+    calendars = await freebusy(user_id, window_start, window_end, calendar_ids)
+
+    # Merge everyone's busy blocks; calendars we can't see (errors) are reported separately
+    busy: List[Dict[str, str]] = []
+    unavailable: List[str] = []
+    for cid in calendar_ids:
+        cal = calendars.get(cid) or {}
+        if cal.get("errors"):
+            unavailable.append(cid)
+        busy.extend(cal.get("busy", []))
+    busy.sort(key=lambda b: b["start"])
+
     return {
         "window_start": window_start,
         "window_end": window_end,
         "busy": busy,
         "participants": participants,
+        "unavailable_calendars": unavailable,
         "duration_minutes": params.get("duration_minutes", 30),
     }
 
@@ -110,7 +121,7 @@ async def create_event(params: Dict[str, Any]) -> Dict[str, Any]:
         raise ValueError("create_event requires start_time and end_time (ISO strings).")
 
     tz_name = params.get("organizer_tz", "America/New_York")
-    tz = ZoneInfo(tz_name)
+    tz = get_tz(tz_name)
 
     try:
         start_dt = dtparse.isoparse(start)
@@ -141,7 +152,7 @@ async def create_event(params: Dict[str, Any]) -> Dict[str, Any]:
 
     conf = params.get("conferencing", "google_meet")
 
-    created = g_create(
+    created = await g_create(
         user_id=user_id,
         title=title,
         start=start_dt.isoformat(),
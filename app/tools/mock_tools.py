@@ -1,8 +1,10 @@
 from __future__ import annotations
+from bisect import bisect_right
 from datetime import datetime, timedelta
 from dateutil import parser as dtparse
-from zoneinfo import ZoneInfo
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
+
+from app.tools.timezones import get_tz
 
 def iso(dt: datetime) -> str:
     return dt.replace(microsecond=0).isoformat()
@@ -19,7 +21,7 @@ async def suggest_times(params: Dict[str, Any]) -> Dict[str, Any]:
     avail = params["availability_blocks"]
 
     tz_name = params.get("organizer_tz") or "America/New_York"
-    tz = ZoneInfo(tz_name)
+    tz = get_tz(tz_name)
 
     # Parse window and coerce tz if missing
     wstart = dtparse.isoparse(avail["window_start"])
@@ -36,8 +38,13 @@ async def suggest_times(params: Dict[str, Any]) -> Dict[str, Any]:
     hend_h, hend_m = map(int, hours["end"].split(":"))
     days = set((prefs.get("days") or []))  # e.g. {"Tue","Wed"}
 
+    # Interval math below runs on epoch seconds: float compares are far cheaper than
+    # tz-aware datetime ones. Only the returned candidates are turned back into datetimes.
+    out_tz = wstart.tzinfo
+    dur = duration.total_seconds()
+
     # Build daily free blocks within work hours
-    free_blocks: List[Dict[str, str]] = []
+    free_blocks: List[Tuple[float, float]] = []
     day_cursor = wstart.replace(hour=hstart_h, minute=hstart_m, second=0, microsecond=0)
     while day_cursor < wend:
         day_start = day_cursor
@@ -47,7 +54,7 @@ async def suggest_times(params: Dict[str, Any]) -> Dict[str, Any]:
             if maybe:
                 d0, d1 = maybe
                 if not days or d0.strftime("%a") in days:
-                    free_blocks.append({"start": iso(d0), "end": iso(d1)})
+                    free_blocks.append((d0.timestamp(), d1.timestamp()))
         # advance one local day (keep tz)
         day_cursor = (day_cursor + timedelta(days=1)).replace(hour=hstart_h, minute=hstart_m)
 
@@ -58,32 +65,33 @@ async def suggest_times(params: Dict[str, Any]) -> Dict[str, Any]:
         be = dtparse.isoparse(b["end"])
         if bs.tzinfo is None: bs = bs.replace(tzinfo=tz)
         if be.tzinfo is None: be = be.replace(tzinfo=tz)
-        busy.append((bs, be))
+        busy.append((bs.timestamp(), be.timestamp()))
 
-    # Subtract busy from free
-    refined: List[Dict[str, str]] = []
-    for block in free_blocks:
-        s = dtparse.isoparse(block["start"]); e = dtparse.isoparse(block["end"])
-        segments = [(s, e)]
-        for (bs, be) in busy:
-            nxt = []
-            for (xs, xe) in segments:
-                if xe <= bs or be <= xs:
-                    nxt.append((xs, xe)); continue
-                if xs < bs: nxt.append((xs, bs))
-                if be < xe: nxt.append((be, xe))
-            segments = nxt
-        for (xs, xe) in segments:
-            if (xe - xs) >= duration:
-                refined.append({"start": iso(xs), "end": iso(xe)})
+    # Sort busy once and merge overlaps so both starts and ends are ascending
+    busy.sort()
+    merged: List[Tuple[float, float]] = []
+    for (bs, be) in busy:
+        if merged and bs <= merged[-1][1]:
+            if be > merged[-1][1]:
+                merged[-1] = (merged[-1][0], be)
+        else:
+            merged.append((bs, be))
+    busy_ends = [be for (_, be) in merged]
 
-    # Propose up to 3 candidates with tz-aware times
+    # Sweep each free block over only the busy intervals that overlap it,
+    # proposing up to 3 candidates with tz-aware times
     proposals = []
-    for block in refined:
-        start_dt = dtparse.isoparse(block["start"])
-        end_dt = start_dt + duration
-        if end_dt <= dtparse.isoparse(block["end"]):
-            proposals.append({"start": iso(start_dt), "end": iso(end_dt), "score": 0.8})
+    for (s, e) in free_blocks:
+        i = bisect_right(busy_ends, s)  # first busy interval ending after s
+        while s < e and len(proposals) < 3:
+            seg_end = min(e, merged[i][0]) if i < len(merged) else e
+            if seg_end - s >= dur:
+                start_dt = datetime.fromtimestamp(s, tz=out_tz)
+                proposals.append({"start": iso(start_dt), "end": iso(start_dt + duration), "score": 0.8})
+            if i >= len(merged) or merged[i][0] >= e:
+                break
+            s = max(s, merged[i][1])
+            i += 1
         if len(proposals) >= 3:
             break
 
@@ -0,0 +1,10 @@
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+
+@lru_cache(maxsize=64)
+def get_tz(name: str) -> ZoneInfo:
+    """
+    ZoneInfo for an IANA name, memoized so tool calls hit a plain dict lookup.
+    """
+    return ZoneInfo(name)